@@ -1,18 +1,29 @@
 #! /usr/bin/env python3
 
-import json
 import os
-import paho.mqtt.client as mqtt
+import queue
+import asyncio
 import sys
 import signal
 import argparse
-import toml
 import time
 import contextlib
-import daemon
-import jinja2
-import notify2
+import collections
+import functools
+import jinja2, jinja2.meta
 import logging, logging.handlers
+from jeepney import DBusAddress, DBusErrorResponse, MatchRule, message_bus, new_method_call
+from jeepney.io.asyncio import open_dbus_router
+from jeepney.wrappers import unwrap_msg
+
+try:
+    import orjson as json
+    def json_dumps(data):
+        return json.dumps(data).decode()
+except ImportError:
+    import json
+    def json_dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
 
 APP_NAME="mqttnotifier"
 
@@ -33,46 +44,348 @@ DEFAULT_FORMAT = {
     "muted": False,
     "timeout": 5,
     "category": None,
+    "batch_window_ms": 200,
+    "batch_lines": 5,
 }
 
 URGENCY_LEVEL = {
-    "low": notify2.URGENCY_LOW,
-    "normal": notify2.URGENCY_NORMAL,
-    "critical": notify2.URGENCY_CRITICAL,
+    "low": 0,
+    "normal": 1,
+    "critical": 2,
+}
+
+NOTIFICATIONS = DBusAddress("/org/freedesktop/Notifications",
+                            bus_name="org.freedesktop.Notifications",
+                            interface="org.freedesktop.Notifications")
+NOTIFY_SIGNATURE = "susssasa{sv}i"
+# D-Bus signature of the hints we send
+NOTIFY_HINTS = {
+    "urgency": "y",
+    "category": "s",
 }
 
 NOTIFICATION_DURATION = 15
 
+# Seconds before the daemon restarts a failed notifier
+RESTART_DELAY = 5
+
+TEMPLATE_VARS = ("title", "topic", "body")
+
+# Shared by all formats, including those of Notifiers created on restart
+JINJA_ENV = jinja2.Environment(auto_reload=False)
+
+# Format of a topic resolved once at startup
+Prepared = collections.namedtuple("Prepared", [
+    "title", "body", "icon", "urgency", "timeout_ms", "category", "muted",
+    "batch_window", "batch_lines", "uses_body",
+])
+
+
+def compile_template(source):
+    """Compile a format string into a function taking the TEMPLATE_VARS
+    as keywords. Plain strings and lone variables skip Jinja rendering."""
+    body = JINJA_ENV.parse(source).body
+    if not body:
+        return lambda **_: ""
+    if (len(body) == 1 and isinstance(body[0], jinja2.nodes.Output)
+            and len(body[0].nodes) == 1):
+        node = body[0].nodes[0]
+        if isinstance(node, jinja2.nodes.TemplateData):
+            return lambda **_: node.data
+        if isinstance(node, jinja2.nodes.Name) and node.name in TEMPLATE_VARS:
+            return lambda **kw: str(kw[node.name])
+    return JINJA_ENV.from_string(source).render
+
+
+def template_vars(source):
+    """Return the TEMPLATE_VARS used by a format string"""
+    return jinja2.meta.find_undeclared_variables(JINJA_ENV.parse(source)) & set(TEMPLATE_VARS)
+
+
+# Bound on the states of a compiled matcher, which can grow exponentially with
+# the number of overlapping wildcard filters (80 such filters already need ~14k)
+MAX_STATES = 10000
+
+
+def compile_matcher(trie):
+    """Compile a trie of topic filters into a deterministic state machine.
+
+    The trie has one nested dict per level, with + and # levels as keys and
+    the (rank, filter) tuple of a filter under the None key of its last level.
+    Return (transitions, accepts): transitions maps (state, level) to the next
+    state, level None standing for any level without its own transition, and
+    accepts maps each state to the best (rank, filter) of topics ending there,
+    or None. State 0 starts topics, state 1 starts $-prefixed topics, which
+    wildcards at the root level do not match. Return None if more than
+    MAX_STATES states would be needed; use match_trie then."""
+    sinks = set() # '#' nodes, that match all the remaining levels
+    def step(nodes, level, wild):
+        following = {}
+        for node in nodes.values():
+            if id(node) in sinks:
+                following[id(node)] = node
+            if level is not None and level in node:
+                following[id(node[level])] = node[level]
+            if wild and "+" in node:
+                following[id(node["+"])] = node["+"]
+            if wild and "#" in node:
+                sinks.add(id(node["#"]))
+                following[id(node["#"])] = node["#"]
+        return following
+
+    states = {}
+    transitions = {}
+    accepts = [None, None]
+    todo = [(0, {id(trie): trie}, True), (1, {id(trie): trie}, False)]
+    def state_of(nodes):
+        key = frozenset(nodes)
+        if key not in states:
+            if len(accepts) >= MAX_STATES:
+                raise OverflowError
+            # "a/#" also matches "a"
+            matches = [n[None] for n in nodes.values() if None in n]
+            matches += [n["#"][None] for n in nodes.values() if None in n.get("#", {})]
+            states[key] = len(accepts)
+            accepts.append(min(matches, default=None))
+            todo.append((states[key], nodes, True))
+        return states[key]
+
+    try:
+        while todo:
+            state, nodes, wild = todo.pop()
+            default = step(nodes, None, wild)
+            if default:
+                transitions[state, None] = state_of(default)
+            levels = {k for n in nodes.values() for k in n if k not in (None, "+", "#")}
+            for level in levels:
+                following = step(nodes, level, wild)
+                if following.keys() != default.keys():
+                    transitions[state, level] = state_of(following)
+    except OverflowError:
+        return None
+    return transitions, accepts
+
+
+def match_trie(trie, topic):
+    """Return the best (rank, filter) of a compile_matcher trie matching topic,
+    walking the trie level by level. Raise KeyError if none matches"""
+    matches = []
+    nodes = [trie]
+    for i, level in enumerate(topic.split("/")):
+        wild = i > 0 or not topic.startswith("$")
+        following = []
+        for node in nodes:
+            if level in node:
+                following.append(node[level])
+            if wild and "+" in node:
+                following.append(node["+"])
+            if wild and None in node.get("#", {}):
+                matches.append(node["#"][None])
+        nodes = following
+    for node in nodes:
+        if None in node:
+            matches.append(node[None])
+        # "a/#" also matches "a"
+        if None in node.get("#", {}):
+            matches.append(node["#"][None])
+    if not matches:
+        raise KeyError(topic)
+    return min(matches)
+
 
 class Notifier:
+    __slots__ = (
+        "host", "port", "test", "topics", "client", "stopping", "failed", "disconnected",
+        "router", "notify_available", "tasks", "pending", "last_id", "prepared", "handlers",
+        "_trie", "_transitions", "_accepts", "_literal_topics", "_match_wild_cached",
+    )
+
     def __init__(self, options):
-        self.__dict__.update(options.__dict__)
+        self.host = options.host
+        self.port = options.port
+        self.test = options.test
+        self.topics = options.topics
         self.client = None
+        self.router = None
+        self.stopping = False
+        self.failed = False
+        self.notify_available = True
+        self.tasks = set()
+        self.pending = {}
+        self.last_id = {}
+
+        # Resolve formats once per topic (None holds the defaults)
+        self.prepared = {}
+        for topic, fmt in [(None, {}), *self.topics.items()]:
+            fmt = DEFAULT_FORMAT | fmt
+            if int(fmt["batch_lines"]) <= 0:
+                raise ValueError(f"batch_lines of topic [{topic}] must be positive")
+            log.debug(f"Using format {fmt} for topic [{topic}]")
+            self.prepared[topic] = Prepared(
+                title=compile_template(fmt["title"]),
+                body=compile_template(fmt["body"]),
+                icon=compile_template(fmt["icon"]),
+                urgency=URGENCY_LEVEL[fmt["urgency"]],
+                timeout_ms=int(fmt["timeout"] * 1000), # convert to ms
+                category=fmt["category"],
+                muted=bool(fmt["muted"]),
+                batch_window=fmt["batch_window_ms"] / 1000,
+                batch_lines=int(fmt["batch_lines"]),
+                uses_body=any("body" in template_vars(fmt[k])
+                              for k in ("title", "body", "icon")),
+            )
+
+        # Message handler of each topic, with its format bound to it
+        self.handlers = {
+            topic: self.drop if p.muted else functools.partial(self.handle, topic, p)
+            for topic, p in self.prepared.items()
+        }
+
+        # Topic filters without wildcards are looked up directly. The others
+        # go in a trie that is compiled into a state machine. Filters are
+        # ranked so that, as before, the first matching filter of the
+        # configuration wins
+        trie = {}
+        literals = []
+        for rank, topic in enumerate(self.topics):
+            levels = topic.split("/")
+            if "+" not in levels and "#" not in levels:
+                literals.append((rank, topic))
+                continue
+            node = trie
+            for level in levels:
+                node = node.setdefault(level, {})
+            node[None] = (rank, topic)
+        self._trie = trie
+        self._transitions, self._accepts = compile_matcher(trie) or (None, None)
+        if self._transitions is None:
+            log.warning("Too many overlapping wildcard topics, matching them without a state machine")
+        self._literal_topics = {}
+        for rank, topic in literals:
+            try:
+                self._literal_topics[topic] = min(self._match_wild(topic), (rank, topic))[1]
+            except KeyError:
+                self._literal_topics[topic] = topic
+        self._match_wild_cached = functools.lru_cache(maxsize=4096)(self._match_wild)
 
     def start(self):
-        # Initialize notify connection
-        notify2.init(APP_NAME)
+        asyncio.run(self.run())
+
+    async def run(self):
+        import paho.mqtt.client as mqtt
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(self.on_loop_error)
+
+        # Connect to the session bus for notifications
+        async with open_dbus_router() as self.router:
+            self.spawn(self.watch_notifications())
+            self.disconnected = asyncio.Event()
+            try:
+                # Connect to mqtt. Its socket is served by the event loop too
+                self.client = mqtt.Client()
+                self.client.on_connect = self.on_connect
+                self.client.on_message = self.on_message
+                self.client.on_disconnect = self.on_disconnect
+                self.client.on_socket_open = self.on_socket_open
+                self.client.on_socket_close = self.on_socket_close
+                self.client.on_socket_register_write = self.on_socket_register_write
+                self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+                loop.add_signal_handler(signal.SIGINT, self.shutdown)
+                loop.add_signal_handler(signal.SIGTERM, self.shutdown)
+                self.client.connect(self.host, self.port, 60)
+                delay = 1
+                while not (self.stopping or self.failed):
+                    await self.disconnected.wait()
+                    self.disconnected.clear()
+                    if self.stopping or self.failed:
+                        break
+                    # Reconnect after an unexpected disconnection, as
+                    # loop_forever did. Shutting down interrupts the delay
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self.disconnected.wait(), delay)
+                    if self.stopping or self.failed:
+                        break
+                    try:
+                        self.client.reconnect()
+                        delay = 1
+                    except OSError as e:
+                        log.warning(f"Reconnection to MQTT broker failed: {e}")
+                        delay = min(2 * delay, 120)
+                        self.disconnected.set()
+            finally:
+                loop.remove_signal_handler(signal.SIGINT)
+                loop.remove_signal_handler(signal.SIGTERM)
+                # stop them before the router they use is closed
+                for task in self.tasks:
+                    task.cancel()
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+                # do not lose the messages still being batched
+                await self.flush_pending()
+
+    def on_loop_error(self, loop, context):
+        """Log errors of callbacks and tasks, asyncio would only print them,
+        and end run() on exceptions so that the notifier is restarted"""
+        log.error(context["message"], exc_info=context.get("exception"))
+        if "exception" in context:
+            self.failed = True
+            self.disconnected.set()
+
+    def on_socket_open(self, client, userdata, sock):
+        asyncio.get_running_loop().add_reader(sock, client.loop_read)
+        self.spawn(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        asyncio.get_running_loop().remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        asyncio.get_running_loop().add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        asyncio.get_running_loop().remove_writer(sock)
+
+    async def misc_loop(self):
+        # keepalive and retries, until the socket is closed
+        while self.client.loop_misc() == 0:
+            await asyncio.sleep(1)
+
+    async def watch_notifications(self):
+        """Track whether a notification daemon is there to show notifications,
+        either running or activatable by the bus"""
+        name = NOTIFICATIONS.bus_name
+        rule = MatchRule(type="signal", sender=message_bus.bus_name,
+                         interface=message_bus.interface, member="NameOwnerChanged")
+        rule.add_arg_condition(0, name)
+        with self.router.filter(rule, queue=asyncio.Queue()) as signals:
+            await self.router.send_and_get_reply(message_bus.AddMatch(rule))
+            activatable, = unwrap_msg(await self.router.send_and_get_reply(
+                message_bus.ListActivatableNames()))
+            activatable = name in activatable
+            owned, = unwrap_msg(await self.router.send_and_get_reply(
+                message_bus.NameHasOwner(name)))
+            self.notify_available = bool(owned) or activatable
+            if not self.notify_available:
+                log.warning("No notification daemon running")
+            while True:
+                _, _, new_owner = (await signals.get()).body
+                self.notify_available = bool(new_owner) or activatable
+                log.info(f"Notification daemon {'started' if new_owner else 'stopped'}")
 
-        # Connect to mqtt
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_disconnect = self.on_disconnect
-
-        self.client.connect(self.host, self.port, 60)
-        try:
-            self.client.loop_forever()
-        except KeyboardInterrupt:
-            log.info("\nShutting down...")
-            self.stop()
-        except Exception as e:
-            self.stop()
-            raise
+    def shutdown(self):
+        log.info("\nShutting down...")
+        self.stopping = True
+        # when connected, run() ends once the DISCONNECT packet is sent
+        if self.client.disconnect() != 0:
+            self.disconnected.set()
 
     def stop(self):
         if self.client:
+            # the event loop that served the socket is gone
+            self.client.on_socket_open = None
+            self.client.on_socket_close = None
+            self.client.on_socket_register_write = None
+            self.client.on_socket_unregister_write = None
             self.client.disconnect()
-            self.client.loop_stop()
         print("Disconnected")
 
     def on_connect(self, client, userdata, flags, rc, properties=None):
@@ -88,74 +401,141 @@ class Notifier:
     def on_disconnect(self, client, userdata, rc, properties=None):
         if rc != 0:
             log.error("Unexpected disconnection (code {rc})")
+        self.disconnected.set()
 
     def find_format(self, topic):
-        for t in self.topics:
-            log.debug(f"matching [{topic}] as [{t}]")
-            if mqtt.topic_matches_sub(t, topic):
-                return self.topics[t]
-        raise KeyError(topic)
+        matched = self._literal_topics.get(topic)
+        if matched is None:
+            matched = self._match_wild_cached(topic)[1]
+        return matched
+
+    def _match_wild(self, topic):
+        """Return the (rank, filter) of the first wildcard filter matching topic"""
+        if self._transitions is None:
+            return match_trie(self._trie, topic)
+        state = 1 if topic.startswith("$") else 0
+        for level in topic.split("/"):
+            following = self._transitions.get((state, level))
+            if following is None:
+                following = self._transitions.get((state, None))
+                if following is None:
+                    raise KeyError(topic)
+            state = following
+        if (matched := self._accepts[state]) is None:
+            raise KeyError(topic)
+        return matched
 
     def on_message(self, client, userdata, msg):
         topic = msg.topic
-        payload = msg.payload.decode('utf-8', errors='ignore')
-        log.debug(f"Received {topic}: {payload}")
+        payload = msg.payload # bytes, only decoded when a format uses it
+        log.debug("Received %s: %s", topic, payload)
 
-        # Parse message if it's JSON
         try:
-            data = json.loads(payload)
-            if isinstance(data, dict):
-                title = data.get('title', topic)
-                body = data.get('message', str(data))
-            else:
-                title = topic
-                body = payload
-        except (json.JSONDecodeError, ValueError):
-            title = topic
-            body = payload
-
-        try:
-            fmt = self.find_format(topic)
+            matched = self.find_format(topic)
         except KeyError:
             log.warning(f"Format for topic [{topic}] not found! Internal bug.")
-            fmt = {}
-
-        fmt = DEFAULT_FORMAT | fmt
-
-        log.debug(f"Using format {fmt}")
+            matched = None
 
-        if fmt["muted"]:
-            log.debug(f"Topic [{topic}] is muted. Do not notify")
-            return
+        try:
+            self.handlers[matched](topic, payload)
+        except Exception:
+            log.exception(f"Failed to handle message on topic [{topic}]")
 
-        rtitle = jinja2.Template(fmt["title"]).render(title=title, topic=topic, body=body)
-        rbody = jinja2.Template(fmt["body"]).render(title=title, topic=topic, body=body)
+    def drop(self, topic, payload):
+        log.debug("Topic [%s] is muted. Do not notify", topic)
 
-        hints = {
-            "icon": jinja2.Template(fmt["icon"]).render(title=title, topic=topic, body=body),
-            "urgency": URGENCY_LEVEL[fmt["urgency"]],
-            "timeout": int(fmt["timeout"] * 1000), # convert to ms
-            "category": fmt["category"],
-        }
-
-        self.notify(rtitle, rbody, **hints)
-        log.debug(f"Notification sent for topic [{topic}]")
+    def handle(self, matched, p, topic, payload):
+        # Parse message if it's JSON (both parsers accept bytes)
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            title = data.get('title', topic)
+            if 'message' in data:
+                body = data['message']
+            elif p.uses_body:
+                body = json_dumps(data)
+            else:
+                body = ""
+        else:
+            title = topic
+            body = payload.decode('utf-8', errors='ignore') if p.uses_body else ""
 
+        rtitle = p.title(title=title, topic=topic, body=body)
+        rbody = p.body(title=title, topic=topic, body=body)
+        ricon = p.icon(title=title, topic=topic, body=body)
 
-    def notify(self, title, body, **hints):
-        log.debug(f"Notify with title=[{title}] body=[{body}] hints=[{' '.join(f'{k}={v}' for k,v in hints.items())}]")
+        # Coalesce bursts of messages on the same topic into one notification
+        if p.batch_window <= 0:
+            self.spawn(self.send(matched, topic, [(rtitle, rbody, ricon)]))
+        elif topic in self.pending:
+            self.pending[topic][1].append((rtitle, rbody, ricon))
+        else:
+            self.pending[topic] = (matched, [(rtitle, rbody, ricon)])
+            self.spawn(self.flush(topic))
+
+    def spawn(self, coro):
+        # keep a reference to running tasks so they are not garbage collected
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, topic):
+        matched, _ = self.pending[topic]
+        await asyncio.sleep(self.prepared[matched].batch_window)
+        await self.send(matched, topic, self.pending.pop(topic)[1])
+
+    async def flush_pending(self):
+        """Send the batches whose flush was cancelled"""
+        for topic, (matched, pending) in list(self.pending.items()):
+            await self.send(matched, topic, pending)
+        self.pending.clear()
+
+    async def send(self, matched, topic, pending):
+        if not self.notify_available:
+            log.debug("No notification daemon, dropping notification for topic [%s]", topic)
+            return
+        p = self.prepared[matched]
+        rtitle, _, ricon = pending[-1]
+        rbody = "\n".join(b for _, b, _ in pending[-p.batch_lines:])
+        replaces_id, expiry = self.last_id.get(topic, (0, None))
+        try:
+            nid = await self.notify(rtitle, rbody, replaces_id=replaces_id,
+                                    icon=ricon, urgency=p.urgency, timeout=p.timeout_ms,
+                                    category=p.category)
+        except DBusErrorResponse as e:
+            if e.name == "org.freedesktop.DBus.Error.ServiceUnknown":
+                # until watch_notifications sees a daemon start
+                self.notify_available = False
+            log.error(f"Failed to notify for topic [{topic}]: {e}")
+            return
+        # While batching, the next burst on the topic updates this
+        # notification in place, as long as it may still be on screen.
+        # Showing it again restarts its timeout
+        if p.batch_window > 0 and p.timeout_ms > 0:
+            if expiry is not None:
+                expiry.cancel()
+            self.last_id[topic] = (nid, asyncio.get_running_loop().call_later(
+                p.timeout_ms / 1000, self.last_id.pop, topic, None))
+        log.debug("Notification sent for topic [%s] (%d messages)", topic, len(pending))
+
+    async def notify(self, title, body, replaces_id=0, icon="", timeout=-1, **hints):
+        """Show a notification, replacing notification replaces_id if not 0.
+        Return the id of the notification."""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"Notify with title=[{title}] body=[{body}] icon=[{icon}] timeout=[{timeout}] hints=[{' '.join(f'{k}={v}' for k,v in hints.items())}]")
         if self.test:
             log.debug("TEST MODE: does not notify")
-            return
-        notify2.init(APP_NAME)
-        n = notify2.Notification(title, body, hints.get("icon", ""))
-        for hint,set_hint in [ ("timeout", n.set_timeout),
-                               ("urgency", n.set_urgency),
-                               ("category", n.set_category) ]:
-            if (hint_val := hints.get(hint)) is not None:
-                set_hint(hint_val)
-        n.show()
-        log.debug(f"Notification sent [{title}], title=[{body}]")
+            return 0
+        dbus_hints = { hint: (NOTIFY_HINTS[hint], hint_val)
+                       for hint, hint_val in hints.items() if hint_val is not None }
+        msg = new_method_call(NOTIFICATIONS, "Notify", NOTIFY_SIGNATURE,
+                              (APP_NAME, replaces_id, icon, title, body,
+                               [], dbus_hints, timeout))
+        nid, = unwrap_msg(await self.router.send_and_get_reply(msg))
+        log.debug("Notification sent [%s], title=[%s]", title, body)
+        return nid
 
 
 
@@ -185,7 +565,12 @@ def main(*args):
 
     options = parser.parse_args(args or None)
 
-    options.topics = toml.load(options.config) if options.config else {}
+    # toml, daemon and paho are imported when needed, so that --help and
+    # argument errors do not pay for them
+    options.topics = {}
+    if options.config:
+        import toml
+        options.topics = toml.load(options.config)
     options.topics |= { t[0]: dict(zip(["body","title"],t[1:]))
                         for t in options.topics_list }
 
@@ -200,17 +585,38 @@ def main(*args):
                                       datefmt="%Y-%m-%d %H:%M:%S")
 
     handler.setFormatter(formatter)
-    log.addHandler(handler)
+    if options.daemon:
+        # syslog writes may block: hand records over to a listener thread
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        log.addHandler(logging.handlers.QueueHandler(log_queue))
+    else:
+        log.addHandler(handler)
     log.setLevel(options.log_level)
 
-    ctx = daemon.DaemonContext(
-        files_preserve=[handler.socket.fileno()]
-    ) if options.daemon else contextlib.nullcontext()
+    # Formats are checked here, while errors can still be shown, rather
+    # than each time the daemon restarts a notifier
+    try:
+        Notifier(options)
+    except Exception as e:
+        parser.error(f"invalid topic format: {e!r}")
+
+    if options.daemon:
+        import daemon
+        ctx = daemon.DaemonContext(
+            files_preserve=[handler.socket.fileno()]
+        )
+    else:
+        ctx = contextlib.nullcontext()
 
     with ctx:
+        if options.daemon:
+            # started after forking, threads do not survive it
+            listener.start()
         try:
             if options.daemon or 1:
                 log.log(NOTICE, f"Daemon started with PID {os.getpid()}")
+            notifier = None
             while True:
                 try:
                     notifier = Notifier(options)
@@ -224,11 +630,14 @@ def main(*args):
                         notifier.stop()
                     except:
                         pass
-                if not options.daemon:
+                # a shutdown asked by a signal is not restarted
+                if not options.daemon or getattr(notifier, "stopping", False):
                     break
+                time.sleep(RESTART_DELAY)
         finally:
             if options.daemon:
                 log.log(NOTICE, f"Daemon stopped (PID {os.getpid()})")
+                listener.stop()
 
 
 if __name__ == "__main__":
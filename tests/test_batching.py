@@ -0,0 +1,97 @@
+import asyncio
+import types
+
+import pytest
+
+import mqttnotifier
+
+
+@pytest.fixture
+def notifications(monkeypatch):
+    """Notify calls as (title, body, replaces_id, nid) tuples. A replaced
+    notification keeps its id, as with notification daemons"""
+    calls = []
+
+    async def notify(self, title, body, replaces_id=0, **hints):
+        nid = replaces_id or 100 + len({c[3] for c in calls})
+        calls.append((title, body, replaces_id, nid))
+        return nid
+
+    # Notifier has __slots__, notify can only be patched on the class
+    monkeypatch.setattr(mqttnotifier.Notifier, "notify", notify)
+    return calls
+
+
+def notifier(topics):
+    return mqttnotifier.Notifier(
+        types.SimpleNamespace(topics=topics, host="h", port=1, test=True))
+
+
+def publish(notifier, topic, *payloads):
+    for payload in payloads:
+        notifier.on_message(None, None, types.SimpleNamespace(topic=topic, payload=payload))
+
+
+def test_coalesce_per_topic(notifications):
+    async def run():
+        n = notifier({"x/#": {"batch_window_ms": 50}})
+        publish(n, "x/a", b"0", b"1", b"2")
+        publish(n, "x/b", b"3")
+        await asyncio.sleep(0.1)
+    asyncio.run(run())
+    assert sorted(notifications) == [
+        ("x/a", "0\n1\n2", 0, 100),
+        ("x/b", "3", 0, 101),
+    ]
+
+
+def test_batch_lines(notifications):
+    async def run():
+        n = notifier({"a": {"batch_window_ms": 50, "batch_lines": 2}})
+        publish(n, "a", b"0", b"1", b"2")
+        await asyncio.sleep(0.1)
+    asyncio.run(run())
+    assert notifications == [("a", "1\n2", 0, 100)]
+
+
+def test_batch_lines_positive():
+    with pytest.raises(ValueError):
+        notifier({"a": {"batch_lines": 0}})
+
+
+def test_no_batching(notifications):
+    async def run():
+        n = notifier({"a": {"batch_window_ms": 0}})
+        publish(n, "a", b"0", b"1")
+        await asyncio.sleep(0.05)
+    asyncio.run(run())
+    assert notifications == [("a", "0", 0, 100), ("a", "1", 0, 101)]
+
+
+def test_replace_until_expired(notifications):
+    async def run():
+        n = notifier({"a": {"batch_window_ms": 10, "timeout": 0.5}})
+        # each burst shows the notification again and restarts its timeout
+        for delay in (0, 0.3, 0.3, 0.7):
+            await asyncio.sleep(delay)
+            publish(n, "a", b"x")
+        await asyncio.sleep(0.05)
+    asyncio.run(run())
+    assert [(replaces_id, nid) for _, _, replaces_id, nid in notifications] == [
+        (0, 100), (100, 100), (100, 100), (0, 101),
+    ]
+
+
+def test_flush_pending(notifications):
+    async def run():
+        n = notifier({"a": {"batch_window_ms": 1000}})
+        publish(n, "a", b"0", b"1")
+        await asyncio.sleep(0)
+        # as run() does on shutdown
+        for task in n.tasks:
+            task.cancel()
+        await asyncio.gather(*n.tasks, return_exceptions=True)
+        await n.flush_pending()
+        assert not n.pending
+    asyncio.run(run())
+    assert notifications == [("a", "0\n1", 0, 100)]
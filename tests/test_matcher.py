@@ -0,0 +1,44 @@
+import itertools
+import random
+import types
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import mqttnotifier
+
+
+def random_filters(rng):
+    filters = []
+    for _ in range(rng.randint(1, 10)):
+        levels = [rng.choice(["a", "b", "$c", "+"])]
+        levels += [rng.choice(["a", "b", "+"]) for _ in range(rng.randint(0, 3))]
+        if rng.random() < 0.35:
+            levels[-1] = "#"
+        filters.append("/".join(levels))
+    return filters
+
+
+def all_topics():
+    for depth in range(1, 5):
+        for levels in itertools.product(["a", "b", "$c", "d"], repeat=depth):
+            yield "/".join(levels)
+
+
+@pytest.mark.parametrize("max_states", [mqttnotifier.MAX_STATES, 0])
+def test_find_format_matches_paho(monkeypatch, max_states):
+    # MAX_STATES = 0 checks the trie walk used beyond the bound
+    monkeypatch.setattr(mqttnotifier, "MAX_STATES", max_states)
+    rng = random.Random(7)
+    for _ in range(300):
+        topics = {f: {} for f in random_filters(rng)}
+        notifier = mqttnotifier.Notifier(
+            types.SimpleNamespace(topics=topics, host="h", port=1, test=True))
+        for topic in all_topics():
+            # the first configured filter wins
+            expected = next((f for f in topics if mqtt.topic_matches_sub(f, topic)), None)
+            try:
+                got = notifier.find_format(topic)
+            except KeyError:
+                got = None
+            assert got == expected, (list(topics), topic)
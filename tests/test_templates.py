@@ -0,0 +1,31 @@
+import pytest
+
+import mqttnotifier
+
+SOURCES = [
+    "",
+    "plain text",
+    "plain text\n",
+    "two lines\n\n",
+    "{{title}}",
+    "{{topic}}",
+    "{{body}}",
+    "{{body}}\n",
+    " {{body}}",
+    "{{ title }}",
+    "{% raw %}{{title}}{% endraw %}",
+    "{% raw %}{% endraw %}",
+    "{# comment #}",
+    "{{title}}: {{body}}",
+    "{{body|upper}}",
+]
+
+VALUES = [None, "", "text", 0, 1.5, True, {"a": [1, "b"]}, [1, None], "<é>"]
+
+
+@pytest.mark.parametrize("source", SOURCES)
+@pytest.mark.parametrize("value", VALUES)
+def test_compile_template_renders_like_jinja(source, value):
+    variables = {"title": value, "topic": "a/b", "body": value}
+    expected = mqttnotifier.JINJA_ENV.from_string(source).render(**variables)
+    assert mqttnotifier.compile_template(source)(**variables) == expected